@@ -1,10 +1,19 @@
+import asyncio
+import hashlib
+import logging
 import streamlit as st
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import httpx
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 from src.document_processor import DocumentProcessor
 from src.qa_chain import QAChain
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -12,7 +21,12 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else None
+# Chat history limits: older messages are dropped, and older answers lose their sources
+MAX_MESSAGES = 50
+MAX_MESSAGES_WITH_SOURCES = 10
+ANSWER_CACHE_DIRECTORY = "data/answer_cache"
+# Seconds to wait for a coroutine on the shared event loop
+ASYNC_TIMEOUT = 120
 
 # Page config
 st.set_page_config(
@@ -49,8 +63,6 @@ st.markdown("""
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "processor" not in st.session_state:
-    st.session_state.processor = DocumentProcessor()
 if "qa_chain" not in st.session_state:
     st.session_state.qa_chain = None
 if "documents_loaded" not in st.session_state:
@@ -61,36 +73,81 @@ if "user_role" not in st.session_state:
     st.session_state.user_role = None
 if "user_name" not in st.session_state:
     st.session_state.user_name = None
+if "user_profile" not in st.session_state:
+    st.session_state.user_profile = None
+
+
+def create_supabase_client() -> Client:
+    """Create a Supabase client backed by a keep-alive HTTP/2 connection pool."""
+    http_client = httpx.Client(
+        http2=True,
+        timeout=10,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40)
+    )
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
+
+
+def get_supabase() -> Client:
+    """Get this session's Supabase client, created once and reused across reruns."""
+    # Per session, not cache_resource: the client holds the signed-in user's auth session
+    if "supabase" not in st.session_state:
+        st.session_state.supabase = create_supabase_client() if SUPABASE_URL and SUPABASE_KEY else None
+    return st.session_state.supabase
+
+
+def build_profile(data: dict) -> dict:
+    """Build the profile dict used by the app from a user_profiles row."""
+    first = data.get("first_name") or ""
+    last = data.get("last_name") or ""
+    return {
+        "role": data.get("role") or "user",
+        "first_name": first,
+        "last_name": last,
+        "full_name": f"{first} {last}".strip()
+    }
+
+
+DEFAULT_PROFILE = {"role": "user", "first_name": "", "last_name": "", "full_name": ""}
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_profile(user_id: str) -> dict:
+    """Fetch a user's profile row from Supabase (cached for 10 minutes per user)."""
+    response = get_supabase().table("user_profiles").select("role, first_name, last_name").eq("id", user_id).single().execute()
+    return response.data or {}
 
 
 def get_user_profile(user_id: str) -> dict:
     """Get user profile from Supabase."""
     try:
-        response = supabase.table("user_profiles").select("role, first_name, last_name").eq("id", user_id).single().execute()
-        if response.data:
-            first = response.data.get("first_name", "")
-            last = response.data.get("last_name", "")
-            return {
-                "role": response.data.get("role", "user"),
-                "first_name": first,
-                "last_name": last,
-                "full_name": f"{first} {last}".strip()
-            }
+        data = fetch_profile(user_id)
+        if data:
+            return build_profile(data)
     except:
         pass
-    return {"role": "user", "first_name": "", "last_name": "", "full_name": ""}
+    return dict(DEFAULT_PROFILE)
+
+
+def get_current_user_profile(user_id: str) -> dict:
+    """Get the signed-in user's profile with one RPC call, falling back to a table lookup."""
+    try:
+        response = get_supabase().rpc("get_profile_for_current_user").execute()
+        return build_profile(response.data[0]) if response.data else dict(DEFAULT_PROFILE)
+    except:
+        return get_user_profile(user_id)
 
 
 def login(email: str, password: str) -> bool:
     """Authenticate user with Supabase."""
     try:
-        response = supabase.auth.sign_in_with_password({
+        response = get_supabase().auth.sign_in_with_password({
             "email": email,
             "password": password
         })
         if response.user:
             st.session_state.user = response.user
-            profile = get_user_profile(response.user.id)
+            profile = get_current_user_profile(response.user.id)
+            st.session_state.user_profile = profile
             st.session_state.user_role = profile["role"]
             st.session_state.user_name = profile["full_name"]
             return True
@@ -102,12 +159,12 @@ def login(email: str, password: str) -> bool:
 def register(email: str, password: str, first_name: str, last_name: str) -> bool:
     """Register new user with Supabase."""
     try:
-        response = supabase.auth.sign_up({
+        response = get_supabase().auth.sign_up({
             "email": email,
             "password": password
         })
         if response.user:
-            supabase.table("user_profiles").update({
+            get_supabase().table("user_profiles").update({
                 "first_name": first_name,
                 "last_name": last_name
             }).eq("id", response.user.id).execute()
@@ -121,45 +178,162 @@ def register(email: str, password: str, first_name: str, last_name: str) -> bool
 def logout():
     """Log out user."""
     try:
-        supabase.auth.sign_out()
+        get_supabase().auth.sign_out()
     except:
         pass
     st.session_state.user = None
     st.session_state.user_role = None
     st.session_state.user_name = None
+    st.session_state.user_profile = None
     st.session_state.messages = []
 
 
+def add_message(message: dict):
+    """Append a chat message, keeping only the most recent ones."""
+    messages = st.session_state.messages
+    messages.append(message)
+    del messages[:-MAX_MESSAGES]
+    for old_message in messages[:-MAX_MESSAGES_WITH_SOURCES]:
+        old_message.pop("sources", None)
+
+
+@st.cache_resource
+def get_processor() -> DocumentProcessor:
+    """Get the document processor shared by all sessions."""
+    return DocumentProcessor()
+
+
+@st.cache_resource
+def get_processing_lock() -> threading.Lock:
+    """Lock that keeps concurrent admins from updating the vector store at once."""
+    return threading.Lock()
+
+
+def answer_cache_path(vector_store) -> str:
+    """Answer cache directory for a vector store, keyed by the chunks it holds.
+    
+    Chains built on an older store keep writing to their own directory, so their
+    answers never leak into the cache of a store with different documents.
+    """
+    chunk_ids = "\n".join(sorted(vector_store.index_to_docstore_id.values()))
+    return os.path.join(ANSWER_CACHE_DIRECTORY, hashlib.sha256(chunk_ids.encode()).hexdigest()[:16])
+
+
+def prune_answer_caches(keep: str = None):
+    """Delete the answer caches of every store except ``keep``."""
+    if not os.path.isdir(ANSWER_CACHE_DIRECTORY):
+        return
+    for name in os.listdir(ANSWER_CACHE_DIRECTORY):
+        path = os.path.join(ANSWER_CACHE_DIRECTORY, name)
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@st.cache_resource(max_entries=2)
+def get_qa_chain(vs_id: int, _vector_store) -> QAChain:
+    """Get the QA chain shared by all sessions for a given vector store."""
+    return QAChain(_vector_store, cache_path=answer_cache_path(_vector_store))
+
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop on a background thread, shared by all sessions for async chain calls."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro, timeout: float = ASYNC_TIMEOUT):
+    """Run a coroutine on the shared event loop and wait up to ``timeout`` for its result."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # Cancel the coroutine too, so it does not keep running on the loop
+        future.cancel()
+        raise
+
+
+@st.cache_resource
+def get_upload_executor() -> ThreadPoolExecutor:
+    """Thread pool that persists uploaded PDFs in the background."""
+    return ThreadPoolExecutor(max_workers=4)
+
+
+def save_uploaded_file(file_path: str, data: bytes):
+    """Write an uploaded PDF to disk."""
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+
+def forget_failed_upload(saved_uploads: dict, file_id: str, name: str, future):
+    """Done-callback for upload writes: log a failed write and let the next rerun retry it."""
+    error = future.exception()
+    if error:
+        logger.error("Failed to save uploaded file %s: %s", name, error)
+        saved_uploads.pop(file_id, None)
+
+
 def initialize_qa_system():
     """Initialize or load the QA system."""
-    processor = st.session_state.processor
-    vector_store = processor.load_vector_store()
+    processor = get_processor()
+    vector_store = processor.vector_store or processor.load_vector_store()
+    if vector_store and vector_store.index.d != processor.embedding_dimension():
+        # Saved with another embedding model; the next Process Documents re-embeds it
+        processor.vector_store = None
+        st.warning("The document index is out of date. An admin needs to process documents again.")
+        return False
     if vector_store:
-        st.session_state.qa_chain = QAChain(vector_store)
+        st.session_state.qa_chain = get_qa_chain(id(vector_store), vector_store)
         st.session_state.documents_loaded = True
         return True
     return False
 
 
-def process_documents():
-    """Process all PDFs in the data directory."""
-    processor = st.session_state.processor
-    with st.spinner("Processing documents..."):
-        documents = processor.load_pdfs()
-        if not documents:
+def process_documents(uploaded_files=None):
+    """Index new PDFs in the data directory and drop deleted ones."""
+    processor = get_processor()
+    # Parse uploads straight from memory rather than re-reading them from disk
+    uploads = {
+        os.path.join(processor.pdf_directory, f.name): f.getvalue()
+        for f in uploaded_files or []
+    }
+    with get_processing_lock(), st.spinner("Processing documents..."):
+        # Build on a private processor; other sessions only see the result once it is saved
+        builder = DocumentProcessor(processor.pdf_directory, embeddings=processor.embeddings)
+        builder.load_vector_store(mmap=False)
+        migrated = builder.migrate_vector_store()
+        documents = builder.load_pdfs(uploads)
+        removed = builder.remove_deleted_pdfs()
+        if not documents and not removed and not migrated:
+            if builder.vector_store:
+                st.info("All documents are already processed.")
+                return True
             st.warning("No PDF documents found in data/pdfs folder.")
             return False
-        chunks = processor.split_documents(documents)
-        processor.create_vector_store(chunks)
-        processor.save_vector_store()
-        st.session_state.qa_chain = QAChain(processor.vector_store)
+        if documents:
+            builder.index_documents(documents)
+        builder.save_vector_store()
+        
+        # Publish the finished store to the shared processor
+        processor.vector_store = builder.vector_store
+        processor.manifest = builder.manifest
+        if not processor.vector_store:
+            prune_answer_caches()
+            st.session_state.qa_chain = None
+            st.session_state.documents_loaded = False
+            st.warning("No text could be extracted from the documents." if documents else "All documents were removed.")
+            return False
+        st.session_state.qa_chain = get_qa_chain(id(processor.vector_store), processor.vector_store)
+        # Cached answers for other document sets may cite documents that changed
+        prune_answer_caches(keep=st.session_state.qa_chain.cache_path)
         st.session_state.documents_loaded = True
         st.success(f"Processed {len(documents)} documents!")
         return True
 
 
 # Check Supabase
-if not supabase:
+if not get_supabase():
     st.error("Supabase not configured! Add credentials to .env file.")
     st.stop()
 
@@ -230,15 +404,31 @@ else:
             )
             
             if uploaded_files:
+                pdf_directory = get_processor().pdf_directory
+                os.makedirs(pdf_directory, exist_ok=True)
+                # file_id -> future of the background write
+                saved_uploads = st.session_state.setdefault("saved_uploads", {})
+                executor = get_upload_executor()
                 for uploaded_file in uploaded_files:
-                    file_path = os.path.join("data/pdfs", uploaded_file.name)
-                    os.makedirs("data/pdfs", exist_ok=True)
-                    with open(file_path, "wb") as f:
-                        f.write(uploaded_file.getbuffer())
-                    st.success(f"Uploaded: {uploaded_file.name}")
+                    # Persist each file once, in the background, instead of on every rerun
+                    future = saved_uploads.get(uploaded_file.file_id)
+                    if future is None:
+                        file_path = os.path.join(pdf_directory, uploaded_file.name)
+                        future = executor.submit(save_uploaded_file, file_path, uploaded_file.getbuffer())
+                        saved_uploads[uploaded_file.file_id] = future
+                        future.add_done_callback(
+                            lambda f, file_id=uploaded_file.file_id, name=uploaded_file.name:
+                                forget_failed_upload(saved_uploads, file_id, name, f)
+                        )
+                    if not future.done():
+                        st.info(f"Saving: {uploaded_file.name}...")
+                    elif future.exception():
+                        st.error(f"Failed to save {uploaded_file.name}: {future.exception()}")
+                    else:
+                        st.success(f"Uploaded: {uploaded_file.name}")
             
             if st.button("Process Documents", use_container_width=True, type="primary"):
-                process_documents()
+                process_documents(uploaded_files)
             
             st.divider()
         
@@ -263,8 +453,6 @@ else:
         
         if st.button("Clear Chat", use_container_width=True, icon=":material/delete:"):
             st.session_state.messages = []
-            if st.session_state.qa_chain:
-                st.session_state.qa_chain.clear_memory()
             st.rerun()
 
     # Main content
@@ -286,22 +474,26 @@ else:
                 with st.expander("Sources"):
                     for i, source in enumerate(message["sources"], 1):
                         st.markdown(f"**Source {i}:** {source['source']} (Page {source['page']})")
-                        st.caption(source['content'][:200] + "...")
+                        st.caption(source["preview"])
 
     # Handle pending question
     if "pending_question" in st.session_state:
         question = st.session_state.pending_question
         del st.session_state.pending_question
         if st.session_state.qa_chain:
-            st.session_state.messages.append({"role": "user", "content": question})
-            with st.spinner("Thinking..."):
-                response = st.session_state.qa_chain.ask(question)
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": response["answer"],
-                "sources": response["sources"]
-            })
-            st.rerun()
+            add_message({"role": "user", "content": question})
+            try:
+                with st.spinner("Thinking..."):
+                    response = run_async(st.session_state.qa_chain.aask(question))
+            except FutureTimeoutError:
+                st.error("Timed out waiting for an answer. Please try again.")
+            else:
+                add_message({
+                    "role": "assistant",
+                    "content": response["answer"],
+                    "sources": response["sources"]
+                })
+                st.rerun()
 
     # Chat input
     if prompt := st.chat_input("Ask your question..."):
@@ -310,22 +502,22 @@ else:
         elif not st.session_state.qa_chain:
             st.error("QA system initializing...")
         else:
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            add_message({"role": "user", "content": prompt})
             with st.chat_message("user"):
                 st.write(prompt)
             
             with st.chat_message("assistant"):
                 with st.spinner("Searching..."):
-                    response = st.session_state.qa_chain.ask(prompt)
-                st.write(response["answer"])
+                    response = st.session_state.qa_chain.ask_stream(prompt)
+                answer = st.write_stream(response["answer"])
                 if response["sources"]:
                     with st.expander("Sources"):
                         for i, source in enumerate(response["sources"], 1):
                             st.markdown(f"**Source {i}:** {source['source']} (Page {source['page']})")
-                            st.caption(source['content'][:200] + "...")
+                            st.caption(source["preview"])
             
-            st.session_state.messages.append({
+            add_message({
                 "role": "assistant",
-                "content": response["answer"],
+                "content": answer,
                 "sources": response["sources"]
             })
@@ -1,31 +1,117 @@
+import hashlib
+import json
 import os
-from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
+import pickle
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+import faiss
+import numpy as np
+import torch
+from pypdf import PdfReader
+from langchain_core.documents import Document
+from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 
+MAX_LOADER_WORKERS = 4
+MAX_SEARCH_THREADS = 4
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+
+def _load_pdf(path: str, data: bytes = None) -> list:
+    """Load a single PDF (module-level so worker processes can pickle it).
+    
+    When ``data`` is given the PDF is parsed from memory instead of read from ``path``.
+    """
+    if data is None:
+        return PyPDFLoader(path).load()
+    reader = PdfReader(BytesIO(data))
+    return [
+        Document(page_content=page.extract_text(), metadata={"source": path, "page": i})
+        for i, page in enumerate(reader.pages)
+    ]
+
+
+def _file_hash(path) -> str:
+    """SHA-256 fingerprint of a file's contents."""
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
 class DocumentProcessor:
-    def __init__(self, pdf_directory: str = "data/pdfs"):
+    def __init__(self, pdf_directory: str = "data/pdfs", embeddings=None):
         self.pdf_directory = pdf_directory
-        self.embeddings = OpenAIEmbeddings()
+        # Pass an existing embeddings object to reuse an already-loaded model
+        self.embeddings = embeddings or HuggingFaceEmbeddings(
+            model_name=EMBEDDING_MODEL,
+            model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+            encode_kwargs={"batch_size": 64, "normalize_embeddings": True}
+        )
         self.vector_store = None
         self.vector_store_path = "data/vector_store"
+        faiss.omp_set_num_threads(min(os.cpu_count() or 1, MAX_SEARCH_THREADS))
+        # Maps sha256 of each indexed PDF to the ids of its chunks
+        self.manifest = {}
+        self._disk_hashes = set()
+        # Float32 vectors of the indexed chunks in index order, loaded on first rebuild
+        self.vectors = None
+        self._vectors_path = None
+        self._embedding_dimension = None
     
-    def load_pdfs(self) -> list:
-        """Load all PDFs from the directory."""
+    def load_pdfs(self, uploads: dict = None) -> list:
+        """Load PDFs from the directory that are not indexed yet.
+        
+        ``uploads`` maps paths inside the directory to PDF bytes still in memory;
+        those are parsed from memory, whether or not they have reached disk yet.
+        """
+        uploads = uploads or {}
         if not os.path.exists(self.pdf_directory):
             os.makedirs(self.pdf_directory)
-            return []
         
-        loader = DirectoryLoader(
-            self.pdf_directory,
-            glob="**/*.pdf",
-            loader_cls=PyPDFLoader,
-            show_progress=True
-        )
-        documents = loader.load()
+        # Fingerprint every PDF; only files with an unseen hash get parsed
+        disk_paths = [str(p) for p in Path(self.pdf_directory).glob("**/*.pdf")]
+        new_files = {}
+        disk_hashes = set()
+        for path in sorted(set(disk_paths) | set(uploads)):
+            data = uploads.get(path)
+            file_hash = hashlib.sha256(data).hexdigest() if data is not None else _file_hash(path)
+            if file_hash not in self.manifest and file_hash not in disk_hashes:
+                new_files[path] = file_hash
+            disk_hashes.add(file_hash)
+        self._disk_hashes = disk_hashes
+        
+        paths = list(new_files)
+        datas = [uploads.get(path) for path in paths]
+        if len(paths) > 1:
+            workers = min(os.cpu_count() or 1, MAX_LOADER_WORKERS, len(paths))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pages = list(executor.map(_load_pdf, paths, datas))
+        else:
+            pages = [_load_pdf(path, data) for path, data in zip(paths, datas)]
+        
+        documents = []
+        for path, file_pages in zip(paths, pages):
+            for doc in file_pages:
+                doc.metadata["file_hash"] = new_files[path]
+                documents.append(doc)
         return documents
     
+    def remove_deleted_pdfs(self) -> int:
+        """Drop chunks of indexed PDFs no longer on disk (call after load_pdfs)."""
+        stale = [h for h in self.manifest if h not in self._disk_hashes]
+        stale_ids = [chunk_id for h in stale for chunk_id in self.manifest.pop(h)]
+        if stale_ids and self.vector_store:
+            self._delete_chunks(stale_ids)
+        return len(stale)
+    
     def split_documents(self, documents: list) -> list:
         """Split documents into chunks for better retrieval."""
         text_splitter = RecursiveCharacterTextSplitter(
@@ -34,42 +120,241 @@ class DocumentProcessor:
             length_function=len
         )
         chunks = text_splitter.split_documents(documents)
+        # Precompute the source preview shown in the UI so it is never re-sliced per render
+        for chunk in chunks:
+            content = chunk.page_content
+            chunk.metadata["preview"] = content[:300] + "..." if len(content) > 300 else content
         return chunks
     
+    def _build_index(self, vectors) -> faiss.Index:
+        """Build an int8-quantized HNSW index over the given vectors."""
+        vectors = np.asarray(vectors, dtype="float32")
+        index = faiss.IndexHNSWSQ(vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        index.train(vectors)
+        index.add(vectors)
+        return index
+    
+    def _stored_vectors(self) -> np.ndarray:
+        """Float32 vectors of the indexed chunks, in index order.
+        
+        Rebuilds start from these rather than from vectors decoded out of the int8
+        index, so quantization error does not pile up across rebuilds.
+        """
+        store = self.vector_store
+        if self.vectors is None and self._vectors_path and os.path.exists(self._vectors_path):
+            self.vectors = np.load(self._vectors_path)
+        if self.vectors is None or self.vectors.shape != (store.index.ntotal, self.embedding_dimension()):
+            # Saved before vectors were kept, or with another embedding model: re-embed the text
+            texts = [
+                store.docstore.search(store.index_to_docstore_id[position]).page_content
+                for position in range(store.index.ntotal)
+            ]
+            self.vectors = np.asarray(self.embeddings.embed_documents(texts), dtype="float32")
+        return self.vectors
+    
+    def _delete_chunks(self, ids: list):
+        """Remove chunks by rebuilding the index (HNSW cannot remove vectors)."""
+        ids = set(ids)
+        store = self.vector_store
+        keep = [
+            position for position, doc_id in sorted(store.index_to_docstore_id.items())
+            if doc_id not in ids
+        ]
+        if not keep:
+            self.vector_store = None
+            self.vectors = None
+            return
+        
+        self.vectors = self._stored_vectors()[keep]
+        store.docstore.delete(list(ids & set(store.index_to_docstore_id.values())))
+        store.index_to_docstore_id = {
+            new_position: store.index_to_docstore_id[old_position]
+            for new_position, old_position in enumerate(keep)
+        }
+        store.index = self._build_index(self.vectors)
+    
     def create_vector_store(self, chunks: list) -> FAISS:
-        """Create FAISS vector store from document chunks."""
-        self.vector_store = FAISS.from_documents(chunks, self.embeddings)
+        """Create FAISS vector store from document chunks, or add them to the loaded one."""
+        if not chunks:
+            return self.vector_store
+        # Longest first so each encoder batch holds inputs of similar length (less padding)
+        chunks = sorted(chunks, key=lambda c: len(c.page_content), reverse=True)
+        texts = [chunk.page_content for chunk in chunks]
+        metadatas = [chunk.metadata for chunk in chunks]
+        ids = [str(uuid.uuid4()) for _ in chunks]
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype="float32")
+        
+        new_docs = {
+            chunk_id: Document(page_content=text, metadata=metadata)
+            for chunk_id, text, metadata in zip(ids, texts, metadatas)
+        }
+        if self.vector_store:
+            store = self.vector_store
+            # The int8 quantizer clips to the range it was trained on, so retrain on old + new
+            # vectors; the loaded index may be memory-mapped and is never added to in place
+            start = store.index.ntotal
+            self.vectors = np.vstack([self._stored_vectors(), vectors])
+            store.index = self._build_index(self.vectors)
+            store.docstore.add(new_docs)
+            store.index_to_docstore_id.update(
+                (start + offset, chunk_id) for offset, chunk_id in enumerate(ids)
+            )
+        else:
+            self.vectors = vectors
+            self.vector_store = FAISS(
+                self.embeddings,
+                self._build_index(vectors),
+                InMemoryDocstore(new_docs),
+                dict(enumerate(ids))
+            )
+        
+        for chunk, chunk_id in zip(chunks, ids):
+            self.manifest.setdefault(chunk.metadata.get("file_hash", ""), []).append(chunk_id)
         return self.vector_store
     
+    def index_documents(self, documents: list) -> int:
+        """Split and index documents from load_pdfs; returns the number of chunks added.
+        
+        Every file is recorded in the manifest, even one without extractable text
+        (e.g. a scanned PDF), so it is not parsed again on the next run.
+        """
+        chunks = self.split_documents(documents)
+        self.create_vector_store(chunks)
+        for doc in documents:
+            self.manifest.setdefault(doc.metadata.get("file_hash", ""), [])
+        return len(chunks)
+    
+    def _store_dir(self) -> str:
+        """Directory of the current store version.
+        
+        Stores saved before versioning kept their files directly in vector_store_path.
+        """
+        try:
+            with open(os.path.join(self.vector_store_path, "CURRENT")) as f:
+                return os.path.join(self.vector_store_path, f.read().strip())
+        except FileNotFoundError:
+            return self.vector_store_path
+    
     def save_vector_store(self):
-        """Save vector store to disk."""
-        if self.vector_store:
-            self.vector_store.save_local(self.vector_store_path)
+        """Save vector store and its manifest to disk as a new store version."""
+        # Each save writes a fresh version directory and then switches the CURRENT pointer with
+        # a single rename, so a crash or a concurrent load never pairs files from two saves
+        os.makedirs(self.vector_store_path, exist_ok=True)
+        version_dir = tempfile.mkdtemp(prefix="v-", dir=self.vector_store_path)
+        try:
+            if self.vector_store:
+                self.vector_store.save_local(version_dir)
+                np.save(os.path.join(version_dir, "vectors.npy"), self._stored_vectors())
+            # Without an index the manifest only lists files that had no text to index
+            with open(os.path.join(version_dir, "manifest.json"), "w") as f:
+                json.dump(self.manifest, f)
+            fd, pointer = tempfile.mkstemp(prefix=".CURRENT-", dir=self.vector_store_path)
+            with os.fdopen(fd, "w") as f:
+                f.write(os.path.basename(version_dir))
+            previous = self._store_dir()
+            os.replace(pointer, os.path.join(self.vector_store_path, "CURRENT"))
+        except BaseException:
+            shutil.rmtree(version_dir, ignore_errors=True)
+            raise
+        self._prune_store_versions(keep={version_dir, previous})
     
-    def load_vector_store(self) -> FAISS:
-        """Load existing vector store from disk."""
-        if os.path.exists(self.vector_store_path):
-            self.vector_store = FAISS.load_local(
-                self.vector_store_path, 
-                self.embeddings,
-                allow_dangerous_deserialization=True
-            )
-            return self.vector_store
-        return None
+    def _prune_store_versions(self, keep: set):
+        """Delete store versions and legacy unversioned files other than ``keep``.
+        
+        The previous version is kept so a load that read the old pointer can still finish.
+        """
+        for name in os.listdir(self.vector_store_path):
+            path = os.path.join(self.vector_store_path, name)
+            if name.startswith("v-") and path not in keep:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name in ("index.faiss", "index.pkl", "vectors.npy", "manifest.json"):
+                os.remove(path)
+    
+    def _rebuild_manifest(self) -> dict:
+        """Derive a manifest for stores saved before manifests existed."""
+        manifest = {}
+        # Hash each file once, not once per chunk
+        keys = {}
+        for doc_id in self.vector_store.index_to_docstore_id.values():
+            source = self.vector_store.docstore.search(doc_id).metadata.get("source", "")
+            if source not in keys:
+                # Chunks whose file is gone get a key that never matches, so they are pruned
+                keys[source] = _file_hash(source) if os.path.isfile(source) else f"missing:{source}"
+            manifest.setdefault(keys[source], []).append(doc_id)
+        return manifest
+    
+    def load_vector_store(self, mmap: bool = True) -> FAISS:
+        """Load existing vector store from disk.
+        
+        By default the quantized vectors are memory-mapped read-only from the file
+        (the HNSW graph is still read into memory); pass ``mmap=False`` before
+        modifying the index.
+        """
+        store_dir = self._store_dir()
+        manifest_path = os.path.join(store_dir, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        self.vectors = None
+        # A version without an index holds only files that had no text to index
+        if not os.path.exists(os.path.join(store_dir, "index.faiss")):
+            return None
+        
+        # IO_FLAG_MMAP alone does not apply to HNSWSQ; MMAP_IFC maps its code storage
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+        index = faiss.read_index(os.path.join(store_dir, "index.faiss"), flags)
+        # Same pickle FAISS.save_local writes next to the index
+        with open(os.path.join(store_dir, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        self.vector_store = FAISS(self.embeddings, index, docstore, index_to_docstore_id)
+        # Only needed to rebuild the index, so read on demand
+        self._vectors_path = os.path.join(store_dir, "vectors.npy")
+        if not os.path.exists(manifest_path):
+            self.manifest = self._rebuild_manifest()
+        
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        return self.vector_store
+    
+    def embedding_dimension(self) -> int:
+        """Size of the vectors the embedding model produces."""
+        if self._embedding_dimension is None:
+            # Works for any Embeddings implementation; computed once per processor
+            self._embedding_dimension = len(self.embeddings.embed_query("x"))
+        return self._embedding_dimension
+    
+    def migrate_vector_store(self) -> bool:
+        """Upgrade a store saved by an older version in memory; True if it needs saving.
+        
+        Rebuilding is slow, so only call this from the processing path, not on page load.
+        """
+        store = self.vector_store
+        if not store or store.index.ntotal == 0:
+            return False
+        index = store.index
+        # Built with a different embedding model (re-embedded by _stored_vectors)
+        # or with an unquantized index
+        if index.d != self.embedding_dimension() or not isinstance(index, faiss.IndexHNSWSQ):
+            store.index = self._build_index(self._stored_vectors())
+            return True
+        return False
     
     def process_new_pdf(self, pdf_path: str):
         """Process a single new PDF and add to vector store."""
-        loader = PyPDFLoader(pdf_path)
-        documents = loader.load()
-        chunks = self.split_documents(documents)
+        file_hash = _file_hash(pdf_path)
+        if file_hash in self.manifest:
+            return 0
         
-        if self.vector_store:
-            self.vector_store.add_documents(chunks)
-        else:
-            self.vector_store = FAISS.from_documents(chunks, self.embeddings)
+        documents = _load_pdf(pdf_path)
+        for doc in documents:
+            doc.metadata["file_hash"] = file_hash
+        added = self.index_documents(documents)
         
         self.save_vector_store()
-        return len(chunks)
+        return added
     
     def get_relevant_documents(self, query: str, k: int = 4) -> list:
         """Retrieve relevant document chunks for a query."""
@@ -1,16 +1,33 @@
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda, RunnableParallel, RunnablePassthrough
+from src.semantic_cache import SemanticCache
+
+# Persist the answer cache after this many new answers
+CACHE_SAVE_EVERY = 20
+
 
 class QAChain:
-    def __init__(self, vector_store):
+    def __init__(self, vector_store, cache_path: str = None):
         self.llm = ChatOpenAI(
             model_name="gpt-4o-mini",
             temperature=0.7
         )
         self.vector_store = vector_store
-        self.retriever = vector_store.as_retriever(search_kwargs={"k": 4})
-        self.chat_history = []
+        self.k = 4
+        # Fetch extra chunks so k remain after dropping duplicates
+        self.fetch_k = 8
+        self._embed_query = lru_cache(maxsize=512)(vector_store.embedding_function.embed_query)
+        # Answers to earlier questions, reused for near-identical questions
+        self.cache_path = cache_path
+        self.answer_cache = SemanticCache.load(cache_path) if cache_path else SemanticCache()
+        # Single worker, so saves never overlap and answers never wait on the disk
+        self._cache_saver = ThreadPoolExecutor(max_workers=1)
         
         self.prompt = PromptTemplate(
             template="""You are UniConnect, an AI assistant specialized in helping international students navigate university processes, immigration documents, and academic requirements.
@@ -25,45 +42,148 @@ Question: {question}
 Provide a helpful, accurate, and friendly response. If citing specific documents or policies, mention the source.""",
             input_variables=["context", "question"]
         )
+        
+        # Built once and reused by every ask
+        self.chain = self.prompt | self.llm | StrOutputParser()
+        # Retrieval and generation as one graph, so invoke/batch/stream take plain questions
+        self.rag_chain = RunnableParallel(
+            docs=RunnableLambda(self._retrieve),
+            question=RunnablePassthrough()
+        ).assign(answer=RunnableLambda(self._chain_inputs) | self.chain)
+    
+    def _embed(self, question: str) -> list:
+        """Embed a question, reusing the cached vector for repeat questions."""
+        return self._embed_query(question.strip().lower())
+    
+    def _dedupe_docs(self, docs: list) -> list:
+        """Drop chunks repeating an earlier chunk's text (e.g. revised PDFs) and keep the top k."""
+        seen = set()
+        unique = []
+        for doc in docs:
+            digest = hashlib.blake2b(doc.page_content.encode(), digest_size=16).digest()
+            if digest not in seen:
+                seen.add(digest)
+                unique.append(doc)
+        return unique[:self.k]
+    
+    def _retrieve(self, question: str) -> list:
+        """Retrieve relevant document chunks for a question."""
+        docs = self.vector_store.similarity_search_by_vector(self._embed(question), k=self.fetch_k)
+        return self._dedupe_docs(docs)
+    
+    async def _aretrieve(self, question: str) -> list:
+        """Async variant of _retrieve that keeps the event loop free."""
+        query_vector = await asyncio.to_thread(self._embed, question)
+        docs = await self.vector_store.asimilarity_search_by_vector(query_vector, k=self.fetch_k)
+        return self._dedupe_docs(docs)
     
     def _format_docs(self, docs):
         return "\n\n".join(doc.page_content for doc in docs)
     
+    def _chain_inputs(self, inputs: dict) -> dict:
+        return {
+            "context": self._format_docs(inputs["docs"]),
+            "question": inputs["question"]
+        }
+    
+    def _format_sources(self, docs) -> list:
+        sources = []
+        for doc in docs:
+            source_info = {
+                "source": doc.metadata.get("source", "Unknown"),
+                "page": doc.metadata.get("page", "N/A"),
+                # Chunks indexed before previews existed fall back to slicing
+                "preview": doc.metadata.get("preview") or doc.page_content[:300]
+            }
+            sources.append(source_info)
+        return sources
+    
+    def _cached_answer(self, question: str) -> dict:
+        """Return the cached response for a similar earlier question, or None."""
+        cached = self.answer_cache.lookup(self._embed(question))
+        if cached is None:
+            return None
+        answer, sources = cached
+        return {
+            "answer": answer,
+            "sources": sources
+        }
+    
+    def _cache_answer(self, question: str, answer: str, sources: list):
+        self.answer_cache.add(self._embed(question), answer, sources)
+        if self.cache_path and self.answer_cache.unsaved >= CACHE_SAVE_EVERY:
+            self._cache_saver.submit(self.answer_cache.save, self.cache_path)
+    
     def ask(self, question: str) -> dict:
         """Ask a question and get an answer with sources."""
-        # Get relevant documents
-        docs = self.retriever.invoke(question)
+        cached = self._cached_answer(question)
+        if cached:
+            return cached
         
-        # Format context
-        context = self._format_docs(docs)
+        # Retrieve relevant documents and generate the answer
+        result = self.rag_chain.invoke(question)
+        docs = result["docs"]
+        answer = result["answer"]
         
-        # Create the chain
-        chain = self.prompt | self.llm | StrOutputParser()
+        # Format sources
+        sources = self._format_sources(docs)
+        
+        self._cache_answer(question, answer, sources)
         
-        # Get answer
-        answer = chain.invoke({
+        return {
+            "answer": answer,
+            "sources": sources
+        }
+    
+    async def aask(self, question: str) -> dict:
+        """Async variant of ask."""
+        cached = await asyncio.to_thread(self._cached_answer, question)
+        if cached:
+            return cached
+        
+        docs = await self._aretrieve(question)
+        context = self._format_docs(docs)
+        
+        answer = await self.chain.ainvoke({
             "context": context,
             "question": question
         })
         
-        # Format sources
-        sources = []
-        for doc in docs:
-            source_info = {
-                "content": doc.page_content[:300] + "..." if len(doc.page_content) > 300 else doc.page_content,
-                "source": doc.metadata.get("source", "Unknown"),
-                "page": doc.metadata.get("page", "N/A")
+        sources = self._format_sources(docs)
+        await asyncio.to_thread(self._cache_answer, question, answer, sources)
+        
+        return {
+            "answer": answer,
+            "sources": sources
+        }
+    
+    def ask_stream(self, question: str) -> dict:
+        """Ask a question and get the answer as a token stream, with sources."""
+        cached = self._cached_answer(question)
+        if cached:
+            return {
+                "answer": iter([cached["answer"]]),
+                "sources": cached["sources"]
             }
-            sources.append(source_info)
         
-        # Store in history
-        self.chat_history.append({"question": question, "answer": answer})
+        docs = self._retrieve(question)
+        context = self._format_docs(docs)
+        sources = self._format_sources(docs)
+        
+        def stream_answer():
+            tokens = []
+            for chunk in self.chain.stream({"context": context, "question": question}):
+                tokens.append(chunk)
+                yield chunk
+            # Cache once the full answer has been generated
+            answer = "".join(tokens)
+            self._cache_answer(question, answer, sources)
         
         return {
-            "answer": answer,
+            "answer": stream_answer(),
             "sources": sources
         }
     
-    def clear_memory(self):
-        """Clear conversation history."""
-        self.chat_history = []
+    def clear_answer_cache(self):
+        """Forget cached answers, e.g. after the indexed documents change."""
+        self.answer_cache.clear(self.cache_path)
@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+import faiss
+import numpy as np
+
+
+class SemanticCache:
+    """Answer cache keyed by question embedding, so near-identical questions skip the LLM."""
+
+    def __init__(self, threshold: float = 0.95, max_size: int = 1000):
+        self.threshold = threshold
+        self.max_size = max_size
+        # Created on first insert, once the embedding dimension is known
+        self.index = None
+        # Entry id -> (answer, sources), least recently used first
+        self.entries = OrderedDict()
+        self._next_id = 0
+        # Entries added since the last save
+        self.unsaved = 0
+        self._lock = threading.Lock()
+
+    def _as_query(self, vector) -> np.ndarray:
+        """Unit-normalize a vector so inner product equals cosine similarity."""
+        query = np.asarray(vector, dtype="float32").reshape(1, -1).copy()
+        faiss.normalize_L2(query)
+        if self.index is not None and self.index.d != query.shape[1]:
+            # Embedding model changed; old entries are not comparable
+            self._reset()
+        return query
+
+    def _reset(self):
+        self.index = None
+        self.entries.clear()
+
+    def lookup(self, vector):
+        """Return the cached (answer, sources) for a similar question, or None."""
+        with self._lock:
+            query = self._as_query(vector)
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            scores, ids = self.index.search(query, 1)
+            if ids[0][0] == -1 or scores[0][0] < self.threshold:
+                return None
+            entry_id = int(ids[0][0])
+            if entry_id not in self.entries:
+                # Index and entries out of sync (e.g. a partially written save)
+                return None
+            self.entries.move_to_end(entry_id)
+            return self.entries[entry_id]
+
+    def add(self, vector, answer: str, sources: list):
+        """Cache an answer, evicting the least recently used entry when full."""
+        with self._lock:
+            query = self._as_query(vector)
+            if self.index is None:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(query.shape[1]))
+            self.index.add_with_ids(query, np.array([self._next_id], dtype="int64"))
+            self.entries[self._next_id] = (answer, sources)
+            self._next_id += 1
+            self.unsaved += 1
+            if len(self.entries) > self.max_size:
+                evicted_id, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([evicted_id], dtype="int64"))
+
+    def clear(self, path: str = None):
+        """Drop all entries, and the saved copy at ``path`` if given."""
+        with self._lock:
+            self._reset()
+        if path:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def save(self, path: str):
+        """Save the cache to a directory (not safe to call concurrently for one path)."""
+        # Snapshot under the lock, write outside it so lookups are not held up by disk I/O
+        with self._lock:
+            if self.index is None:
+                return
+            index_bytes = faiss.serialize_index(self.index)
+            data = {
+                "next_id": self._next_id,
+                "entries": [[entry_id, answer, sources] for entry_id, (answer, sources) in self.entries.items()]
+            }
+            self.unsaved = 0
+        os.makedirs(path, exist_ok=True)
+        index_bytes.tofile(os.path.join(path, "index.tmp"))
+        with open(os.path.join(path, "entries.tmp"), "w") as f:
+            json.dump(data, f)
+        os.replace(os.path.join(path, "index.tmp"), os.path.join(path, "index.faiss"))
+        os.replace(os.path.join(path, "entries.tmp"), os.path.join(path, "entries.json"))
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "SemanticCache":
+        """Load a cache saved with save, or return an empty one."""
+        cache = cls(**kwargs)
+        try:
+            index = faiss.read_index(os.path.join(path, "index.faiss"))
+            with open(os.path.join(path, "entries.json")) as f:
+                data = json.load(f)
+        except (OSError, RuntimeError, ValueError):
+            return cache
+        if index.ntotal != len(data["entries"]):
+            # Index and entries saved by different writers; start over
+            return cache
+        cache.index = index
+        cache._next_id = data["next_id"]
+        cache.entries = OrderedDict(
+            (entry_id, (answer, sources)) for entry_id, answer, sources in data["entries"]
+        )
+        return cache
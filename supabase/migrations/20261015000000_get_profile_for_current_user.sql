@@ -0,0 +1,14 @@
+-- Profile of the signed-in user, fetched with a single RPC call right after login.
+create or replace function public.get_profile_for_current_user()
+returns table (role text, first_name text, last_name text)
+language sql
+stable
+security invoker
+set search_path = public
+as $$
+    select role::text, first_name::text, last_name::text
+    from public.user_profiles
+    where id = auth.uid();
+$$;
+
+grant execute on function public.get_profile_for_current_user() to authenticated;